@@ -1,122 +1,635 @@
 import gradio as gr
-from openai import OpenAI
+from openai import AsyncOpenAI
 import os
-import json
+import posixpath
+import asyncio
+import httpx
+import orjson
+import msgspec
 import threading
 import time
 import atexit
+import logging
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Callable
+from hashlib import sha256
 from novita_sandbox.code_interpreter import Sandbox
+from novita_sandbox.core import SandboxException
+
+# -------------------------
+# Logging
+# -------------------------
+log = logging.getLogger("gradio_chat")
+# Accept any case and fall back to INFO rather than failing at import
+_log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
+log.setLevel(_log_level if isinstance(logging.getLevelName(_log_level), int) else logging.INFO)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+log.addHandler(_log_handler)
 
 # -------------------------
 # Global State
 # -------------------------
-client = OpenAI(
+# One pooled HTTP/2 client so concurrent sessions share warm connections
+_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+
+client = AsyncOpenAI(
     base_url="https://api.novita.ai/openai",
     api_key=os.environ["NOVITA_API_KEY"],
+    http_client=_http_client,
 )
 
 model = "meta-llama/llama-3.3-70b-instruct"
 
-sandbox = None
-sandbox_timer = None
+SANDBOX_POOL_SIZE = 8
+WORKING_DIR = "/tmp/working-dir"
+MAX_WRITE_DATA = 32 * 1024
+MAX_TOOL_CONTENT = 4096
+TOOL_OUTPUT_DIR = "/tmp/tool_outputs"
+
+# -------------------------
+# LLM Response Cache
+# -------------------------
+_CACHE_MAX = 512
+_LLM_CACHE = OrderedDict()
+_llm_cache_lock = threading.Lock()
+
+# Optional on-disk cache so identical requests are reused across runs
+_llm_disk_cache = None
+if os.environ.get("LLM_CACHE_DIR"):
+    import diskcache
+    _llm_disk_cache = diskcache.Cache(os.environ["LLM_CACHE_DIR"])
+
+def _cache_key(model, messages, request_tools):
+    payload = {
+        "model": model,
+        "messages": messages,
+    }
+    h = sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str))
+    # The registered schema is serialized once at import; reuse those bytes
+    if request_tools is tools:
+        h.update(_TOOLS_JSON)
+    elif request_tools is not None:
+        h.update(orjson.dumps(request_tools, option=orjson.OPT_SORT_KEYS))
+    return h.hexdigest()
+
+def _remember_response(key, message):
+    with _llm_cache_lock:
+        _LLM_CACHE[key] = message
+        if len(_LLM_CACHE) > _CACHE_MAX:
+            _LLM_CACHE.popitem(last=False)
+
+async def _cache_get(key):
+    with _llm_cache_lock:
+        if key in _LLM_CACHE:
+            _LLM_CACHE.move_to_end(key)
+            return _LLM_CACHE[key]
+    if _llm_disk_cache is None:
+        return None
+
+    # diskcache is blocking SQLite I/O, so keep it off the event loop
+    message = await asyncio.to_thread(_llm_disk_cache.get, key)
+    if message is not None:
+        _remember_response(key, message)
+    return message
+
+async def _cache_put(key, message):
+    _remember_response(key, message)
+    if _llm_disk_cache is not None:
+        await asyncio.to_thread(_llm_disk_cache.set, key, message)
+
+# -------------------------
+# Streaming Completions
+# -------------------------
+async def stream_completion(on_tool_call=None, **kwargs):
+    """Stream a chat completion as (text so far, message) pairs.
+
+    Each tool call is passed to on_tool_call(tc, final) whenever its
+    arguments might be complete, so callers can start running it before the
+    stream ends; final is True once the arguments can no longer grow.
+    message is None until the last pair, which carries the assembled
+    assistant message as a dict.
+    """
+    # Sampling with a non-zero temperature is not reproducible, so never cache it
+    key = None
+    if not kwargs.get("temperature"):
+        key = _cache_key(kwargs["model"], kwargs["messages"], kwargs.get("tools"))
+        message = await _cache_get(key)
+        if message is not None:
+            for tc in message.get("tool_calls", []):
+                if on_tool_call:
+                    on_tool_call(tc, True)
+            yield message["content"] or "", message
+            return
+
+    content = ""
+    calls = {}
+    async for chunk in await client.chat.completions.create(stream=True, **kwargs):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+
+        if delta.content:
+            content += delta.content
+            yield content, None
+
+        for d in delta.tool_calls or []:
+            tc = calls.setdefault(d.index, {
+                "id": None,
+                "type": "function",
+                "function": {"name": "", "arguments": ""},
+            })
+            if d.id:
+                tc["id"] = d.id
+            if d.function and d.function.name:
+                tc["function"]["name"] += d.function.name
+            if d.function and d.function.arguments:
+                tc["function"]["arguments"] += d.function.arguments
+            # Tool arguments are a JSON object, so they can only be complete once closed
+            if on_tool_call and tc["function"]["arguments"].endswith("}"):
+                on_tool_call(tc, False)
+
+    message = {"role": "assistant", "content": content or None}
+    if calls:
+        message["tool_calls"] = [calls[i] for i in sorted(calls)]
+        # Hand over any call whose arguments never parsed mid-stream
+        for tc in message["tool_calls"]:
+            if on_tool_call:
+                on_tool_call(tc, True)
+
+    if key is not None:
+        await _cache_put(key, message)
+    yield content, message
 
 # -------------------------
 # Sandbox Management
 # -------------------------
-def create_sandbox():
-    global sandbox
-    if sandbox is None:
-        sandbox = Sandbox.create(timeout=1200)
-        print("[DEBUG] Sandbox created.")
+class SandboxPool:
+    """Sandboxes keyed by Gradio session, evicting the least recently used."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._sandboxes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            sbx = self._sandboxes.get(session_id)
+            if sbx is not None:
+                self._sandboxes.move_to_end(session_id)
+            return sbx
+
+    def acquire(self, session_id):
+        sbx = self.get(session_id)
+        if sbx is not None:
+            return sbx
+
+        # Creating a sandbox is slow, so don't hold the lock while doing it
+        sbx = Sandbox.create(timeout=1200)
+        log.info("Sandbox created for session %s.", session_id)
+        evicted = []
+        with self._lock:
+            if session_id in self._sandboxes:
+                evicted.append(sbx)
+                sbx = self._sandboxes[session_id]
+            else:
+                self._sandboxes[session_id] = sbx
+                while len(self._sandboxes) > self.max_size:
+                    evicted.append(self._sandboxes.popitem(last=False)[1])
+        for old in evicted:
+            _kill(old)
+        return sbx
+
+    def evict(self, session_id):
+        with self._lock:
+            sbx = self._sandboxes.pop(session_id, None)
+        if sbx is None:
+            return False
+        _kill(sbx)
+        log.info("Sandbox killed for session %s.", session_id)
+        return True
+
+    def kill_all(self):
+        with self._lock:
+            sandboxes = list(self._sandboxes.values())
+            self._sandboxes.clear()
+        for sbx in sandboxes:
+            _kill(sbx)
+
+def _kill(sbx):
+    _forget_reads(sbx)
+    try:
+        sbx.kill()
+    except Exception:
+        pass
+
+pool = SandboxPool(max_size=SANDBOX_POOL_SIZE)
+
+def create_sandbox(session_id):
+    if pool.get(session_id) is None:
+        pool.acquire(session_id)
         return "🟢 Sandbox ON"
     return "Sandbox already running."
 
-def kill_sandbox():
-    global sandbox
-    if sandbox is not None:
-        try:
-            sandbox.kill()
-        except Exception:
-            pass
-        sandbox = None
-        print("[DEBUG] Sandbox killed.")
+def kill_sandbox(session_id):
+    if pool.evict(session_id):
         return "🔴 Sandbox OFF"
     return "Sandbox already off."
 
-def sandbox_auto_off():
-    print("[DEBUG] Auto-off countdown started (1200 sec).")
+def sandbox_auto_off(session_id):
+    log.info("Auto-off countdown started (1200 sec).")
     time.sleep(1200)
-    print("[DEBUG] Auto-off triggered.")
-    kill_sandbox()
+    log.info("Auto-off triggered.")
+    kill_sandbox(session_id)
 
 # -------------------------
 # Sandbox Usage Guard
 # -------------------------
-def require_sandbox():
-    if sandbox is None:
+def require_sandbox(sbx):
+    if sbx is None:
         return "❌ Sandbox is OFF. Turn it ON to use this feature."
     return None
 
+class SandboxGone(Exception):
+    """The sandbox behind a tool call is no longer running."""
+
+def raise_if_gone(sbx, e):
+    # Sandbox errors also cover request timeouts on a live sandbox, so only
+    # treat the sandbox as dead once it reports that it isn't running
+    if not isinstance(e, (SandboxException, httpx.TransportError)):
+        return
+    try:
+        running = sbx.is_running()
+    except Exception:
+        running = False
+    if not running:
+        raise SandboxGone(str(e)) from e
+
+def run_in_sandbox(session_id, fn, **kwargs):
+    sbx = pool.get(session_id)
+    try:
+        return fn(sbx, **kwargs)
+    except SandboxGone as e:
+        # The session's sandbox died; replace it and retry once
+        log.warning("Sandbox lost (%s), recreating.", e)
+        pool.evict(session_id)
+        return fn(pool.acquire(session_id), **kwargs)
+
+def check_write_size(path, data):
+    # Bulk content should not be pushed through tool-call arguments
+    if len(data) > MAX_WRITE_DATA:
+        return (
+            f"Error: data for {path} is {len(data)} characters, over the {MAX_WRITE_DATA} limit. "
+            "Split it into smaller files, or generate it inside the sandbox with run_commands."
+        )
+    return None
+
+# -------------------------
+# Read Cache
+# -------------------------
+_READ_CACHE_MAX = 256
+_read_cache = OrderedDict()  # (id(sbx), path) -> content
+_read_generation = {}  # id(sbx) -> number of invalidations so far
+_read_cache_lock = threading.Lock()
+
+def _cache_path(path):
+    # Relative paths depend on the sandbox's working directory, so only
+    # absolute paths are cached, normalized the same way as the scheduler
+    if not path.startswith("/"):
+        return None
+    return posixpath.normpath(path)
+
+def _cached_read(sbx, path):
+    path = _cache_path(path)
+    if path is None:
+        return None
+    with _read_cache_lock:
+        key = (id(sbx), path)
+        if key in _read_cache:
+            _read_cache.move_to_end(key)
+            return _read_cache[key]
+    return None
+
+def _read_started(sbx):
+    with _read_cache_lock:
+        return _read_generation.get(id(sbx), 0)
+
+def _remember_read(sbx, path, content, generation):
+    path = _cache_path(path)
+    if path is None:
+        return
+    with _read_cache_lock:
+        # Something may have changed the file while the read was in flight
+        if _read_generation.get(id(sbx), 0) != generation:
+            return
+        _read_cache[(id(sbx), path)] = content
+        if len(_read_cache) > _READ_CACHE_MAX:
+            _read_cache.popitem(last=False)
+
+def _forget_reads(sbx, paths=None):
+    # With no paths, drop everything cached for this sandbox
+    if paths is not None:
+        paths = [_cache_path(p) for p in paths]
+        # A relative path may name any cached file
+        if None in paths:
+            paths = None
+    with _read_cache_lock:
+        _read_generation[id(sbx)] = _read_generation.get(id(sbx), 0) + 1
+        if paths is not None:
+            for path in paths:
+                _read_cache.pop((id(sbx), path), None)
+            return
+        for key in [k for k in _read_cache if k[0] == id(sbx)]:
+            del _read_cache[key]
+
 # -------------------------
 # Tool Functions
 # -------------------------
-def read_file(path: str):
-    print(f"[DEBUG] read_file called with path: {path}")
-    err = require_sandbox()
+def read_file(sbx, path: str) -> str:
+    log.debug("read_file called with path: %s", path)
+    err = require_sandbox(sbx)
     if err:
         return err
 
+    content = _cached_read(sbx, path)
+    if content is not None:
+        log.debug("read_file cache hit: %s", path)
+        return content
+
+    generation = _read_started(sbx)
     try:
-        content = sandbox.files.read(path)
-        print(f"[DEBUG] read_file result: {content}")
+        content = sbx.files.read(path)
+        log.debug("read_file result: %d chars", len(content))
+        _remember_read(sbx, path, content, generation)
         return content
     except Exception as e:
-        print(f"[DEBUG] read_file error: {e}")
+        raise_if_gone(sbx, e)
+        log.debug("read_file error: %s", e)
         return f"Error reading file: {e}"
 
-def write_file(path: str, data: str):
-    print(f"[DEBUG] write_file called with path: {path}")
-    err = require_sandbox()
+def write_file(sbx, path: str, data: str) -> str:
+    log.debug("write_file called with path: %s", path)
+    err = require_sandbox(sbx) or check_write_size(path, data)
     if err:
         return err
 
     try:
-        sandbox.files.write(path, data)
+        sbx.files.write(path, data)
         msg = f"File created successfully at {path}"
-        print(f"[DEBUG] {msg}")
+        log.debug(msg)
         return msg
     except Exception as e:
-        print(f"[DEBUG] write_file error: {e}")
+        raise_if_gone(sbx, e)
+        log.debug("write_file error: %s", e)
         return f"Error writing file: {e}"
-
-def write_files(files: list):
-    print(f"[DEBUG] write_files called with {len(files)} files")
-    err = require_sandbox()
+    finally:
+        _forget_reads(sbx, [path])
+
+def write_files(sbx, files: list) -> str:
+    log.debug("write_files called with %d files", len(files))
+    err = require_sandbox(sbx)
+    for f in files:
+        err = err or check_write_size(f["path"], f["data"])
     if err:
         return err
 
     try:
-        sandbox.files.write_files(files)
+        sbx.files.write_files(files)
         msg = f"{len(files)} file(s) created successfully"
-        print(f"[DEBUG] {msg}")
+        log.debug(msg)
         return msg
     except Exception as e:
-        print(f"[DEBUG] write_files error: {e}")
+        raise_if_gone(sbx, e)
+        log.debug("write_files error: %s", e)
         return f"Error writing multiple files: {e}"
+    finally:
+        _forget_reads(sbx, [f["path"] for f in files])
 
-def run_commands(command: str):
-    print(f"[DEBUG] run_commands called with command: {command}")
-    err = require_sandbox()
+def run_commands(sbx, command: str) -> str:
+    log.debug("run_commands called with command: %s", command)
+    err = require_sandbox(sbx)
     if err:
         return err
 
     try:
-        result = sandbox.commands.run(command)
-        print(f"[DEBUG] run_commands result: {result.stdout}")
-        return result.stdout
+        result = sbx.commands.run(command)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("run_commands result: %s", result.stdout)
+        return _format_command_result(result)
     except Exception as e:
-        print(f"[DEBUG] run_commands error: {e}")
+        raise_if_gone(sbx, e)
+        log.debug("run_commands error: %s", e)
+        # A non-zero exit is raised as an error that still carries the output
+        if hasattr(e, "exit_code"):
+            return _format_command_result(e)
         return f"Error running command: {e}"
+    finally:
+        # A shell command can touch any file
+        _forget_reads(sbx)
+
+def _format_command_result(result):
+    return f"exit={result.exit_code}\n--stdout--\n{result.stdout}\n--stderr--\n{result.stderr}"
+
+def stage_file(sbx, path: str, data: bytes) -> str:
+    # Uploads from the UI go straight to the sandbox, never through the model
+    log.debug("stage_file called with path: %s", path)
+    err = require_sandbox(sbx)
+    if err:
+        return err
+
+    try:
+        sbx.files.write(path, data)
+        return f"File staged at {path}"
+    except Exception as e:
+        raise_if_gone(sbx, e)
+        log.debug("stage_file error: %s", e)
+        return f"Error staging file: {e}"
+    finally:
+        _forget_reads(sbx, [path])
+
+# -------------------------
+# Tool Dispatch
+# -------------------------
+class ReadArgs(msgspec.Struct):
+    path: str
+
+class WriteArgs(msgspec.Struct):
+    path: str
+    data: str
+
+class WriteFilesArgs(msgspec.Struct):
+    files: list[WriteArgs]
+
+class RunArgs(msgspec.Struct):
+    command: str
+
+# Tool name -> handler; each handler takes the sandbox plus the tool's arguments
+TOOLS: dict[str, Callable[..., str]] = {
+    "read_file": read_file,
+    "write_file": write_file,
+    "write_files": write_files,
+    "run_commands": run_commands,
+}
+
+# Typed decoders validate tool arguments while parsing them
+_DECODERS = {
+    "read_file": msgspec.json.Decoder(ReadArgs),
+    "write_file": msgspec.json.Decoder(WriteArgs),
+    "write_files": msgspec.json.Decoder(WriteFilesArgs),
+    "run_commands": msgspec.json.Decoder(RunArgs),
+}
+
+def decode_tool_args(tc):
+    """Decode a tool call's arguments once, into its typed struct.
+
+    Returns (args, error); error is a result string for the model when the
+    tool is unknown or its arguments don't match the schema. Raises
+    msgspec.DecodeError while the arguments are still incomplete JSON.
+    """
+    fn_name = tc["function"]["name"]
+    decoder = _DECODERS.get(fn_name)
+    if decoder is None:
+        return None, f"Error: Unknown tool {fn_name}"
+    try:
+        return decoder.decode(tc["function"]["arguments"]), None
+    except msgspec.ValidationError as e:
+        return None, f"Error calling {fn_name}: {e}"
+
+def _call_tool(session_id, tc, args):
+    fn_name = tc["function"]["name"]
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Tool call detected: %s with args %s", fn_name, tc["function"]["arguments"])
+    handler = TOOLS[fn_name]
+
+    # Errors are returned as text so one failing call doesn't abort the batch
+    try:
+        result = run_in_sandbox(session_id, handler, **msgspec.to_builtins(args))
+    except Exception as e:
+        result = f"Error calling {fn_name}: {e}"
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Tool call result: %s", result)
+    return _cap_tool_output(session_id, tc["id"], result)
+
+def _cap_tool_output(session_id, tc_id, result):
+    # Everything kept in the history is re-sent on every later turn, so keep
+    # only the head and tail and leave the full output in the sandbox
+    content = result if isinstance(result, str) else str(result)
+    if len(content) <= MAX_TOOL_CONTENT:
+        return result
+
+    half = MAX_TOOL_CONTENT // 2
+    path = f"{TOOL_OUTPUT_DIR}/{tc_id}.txt"
+    sbx = pool.get(session_id)
+    try:
+        sbx.files.write(path, content)
+        _forget_reads(sbx, [path])
+        where = f"full output at {path}; inspect parts of it with run_commands (e.g. sed -n, grep)"
+    except Exception as e:
+        log.debug("Saving tool output failed: %s", e)
+        where = "full output could not be saved"
+
+    return (
+        f"[truncated; {len(content)} chars total; {where}]\n"
+        f"--head--\n{content[:half]}\n"
+        f"--tail--\n{content[-half:]}"
+    )
+
+def _call_write_batch(session_id, batch):
+    """Run a run of adjacent write_file calls as one write_files RPC.
+
+    batch holds (tool call, WriteArgs) pairs. Returns a dict of per-call
+    results keyed by tool call id.
+    """
+    results = {}
+    files, written = [], []
+    for tc, args in batch:
+        err = check_write_size(args.path, args.data)
+        if err:
+            results[tc["id"]] = err
+            continue
+        files.append({"path": args.path, "data": args.data})
+        written.append((tc["id"], args.path))
+
+    if files:
+        log.debug("Batching %d write_file call(s) into write_files", len(files))
+        try:
+            msg = run_in_sandbox(session_id, write_files, files=files)
+        except Exception as e:
+            msg = f"Error writing multiple files: {e}"
+        ok = msg == f"{len(files)} file(s) created successfully"
+        for tc_id, path in written:
+            results[tc_id] = f"File created successfully at {path}" if ok else msg
+    return results
+
+def _tool_paths(args):
+    # Paths a decoded tool call touches
+    if isinstance(args, WriteFilesArgs):
+        return [posixpath.normpath(f.path) for f in args.files]
+    return [posixpath.normpath(args.path)]
+
+class ToolScheduler:
+    """Runs one turn's tool calls in worker threads without reordering conflicts.
+
+    run_commands can touch anything, so it waits for every earlier call and
+    every later call waits for it. A write waits for earlier calls on the
+    same path, and a read waits for the last write to its path. Reads, and
+    writes to different paths, overlap.
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self._tasks = []
+        self._barrier = None
+        self._writes = {}   # path -> last write task
+        self._reads = {}    # path -> reads since that write
+
+    def submit(self, tc, args):
+        name = tc["function"]["name"]
+        if name == "run_commands":
+            return self._schedule(None, None, _call_tool, self.session_id, tc, args)
+        kind = "write" if name in ("write_file", "write_files") else "read"
+        return self._schedule(kind, _tool_paths(args), _call_tool, self.session_id, tc, args)
+
+    def submit_writes(self, batch):
+        # A batched write is ordered like the write_file calls it replaces
+        paths = [p for _, args in batch for p in _tool_paths(args)]
+        return self._schedule("write", paths, _call_write_batch, self.session_id, batch)
+
+    def _schedule(self, kind, paths, fn, *args):
+        if kind is None:
+            deps = list(self._tasks)
+        else:
+            deps = [self._barrier] if self._barrier is not None else []
+            for path in paths:
+                if path in self._writes:
+                    deps.append(self._writes[path])
+                if kind == "write":
+                    deps.extend(self._reads.get(path, []))
+
+        task = asyncio.create_task(self._run_after(deps, fn, *args))
+        self._tasks.append(task)
+        if kind is None:
+            self._barrier = task
+        else:
+            for path in paths:
+                if kind == "write":
+                    self._writes[path] = task
+                    self._reads[path] = []
+                else:
+                    self._reads.setdefault(path, []).append(task)
+        return task
+
+    @staticmethod
+    async def _run_after(deps, fn, *args):
+        if deps:
+            await asyncio.wait(deps)
+        return await asyncio.to_thread(fn, *args)
 
 # -------------------------
 # Register tools
@@ -177,7 +690,11 @@ tools = [
         "type": "function",
         "function": {
             "name": "run_commands",
-            "description": "Run a shell command inside the sandbox",
+            "description": (
+                "Run a shell command inside the sandbox. Returns the exit code on the first "
+                "line as exit=<code>, followed by the command's output after --stdout-- "
+                "and its error output after --stderr--"
+            ),
             "parameters": {
                 "type": "object",
                 "properties": {"command": {"type": "string"}},
@@ -187,78 +704,245 @@ tools = [
     },
 ]
 
+class _FrozenDict(tuple):
+    """Sorted (key, value) pairs standing in for a dict."""
+
+def _freeze(o):
+    if isinstance(o, dict):
+        return _FrozenDict(sorted((k, _freeze(v)) for k, v in o.items()))
+    if isinstance(o, (list, tuple)):
+        return tuple(_freeze(x) for x in o)
+    return o
+
+def _thaw(o):
+    if isinstance(o, _FrozenDict):
+        return {k: _thaw(v) for k, v in o}
+    if isinstance(o, tuple):
+        return [_thaw(x) for x in o]
+    return o
+
+# Freezing fixes the order of every key, so the schema serializes to the same
+# bytes on every start; the request cache and provider prefix cache both rely on it
+_TOOLS_FROZEN = _freeze(sorted(tools, key=lambda t: t["function"]["name"]))
+tools = tuple(_thaw(_TOOLS_FROZEN))
+_TOOLS_JSON = orjson.dumps(tools)
+
 # -------------------------
 # Chat + Tool Call Debug
 # -------------------------
-messages = []
+SYSTEM_PROMPT = (
+    "You are a coding assistant with access to a Linux sandbox. "
+    "Use the provided tools to work with it: read_file to inspect a file, "
+    "write_file to create a single file, write_files to create several files at once, "
+    "and run_commands to run shell commands. "
+    f"Keep your work inside {WORKING_DIR} unless the user asks otherwise. "
+    "If a tool returns an error, explain it to the user instead of guessing at the result."
+)
+
+MAX_TURNS = 20
+MAX_MESSAGES = 64
+TURN_HEADROOM = 16  # room for one turn's user, assistant and tool messages
+SUMMARY_MODEL = "qwen/qwen3-coder-30b-a3b-instruct"
 
 def set_model(selected_model):
     global model
     model = selected_model
     return f"✅ Model switched to **{model}**"
 
-def chat_fn(user_message, history):
-    global messages, model
-
-    messages.append({"role": "user", "content": user_message})
-
-    response = client.chat.completions.create(
+def new_session_state():
+    # Only the recent turns live in the deque; the system prompt and the
+    # summary of evicted turns are pinned in front when building a request
+    return {"summary": None, "messages": deque(maxlen=MAX_MESSAGES)}
+
+def _request_messages(state):
+    head = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if state["summary"]:
+        head.append({"role": "system", "content": f"Summary of the earlier conversation: {state['summary']}"})
+
+    # History is only ever cut on a user message; this guards against a
+    # leading tool result being sent without its call
+    recent = list(state["messages"])
+    start = next((i for i, m in enumerate(recent) if m["role"] == "user"), len(recent))
+    return head + recent[start:]
+
+async def _summarize(dropped, previous=None):
+    transcript = "\n".join(
+        f"{m['role']}: {m.get('content') or orjson.dumps(m.get('tool_calls')).decode()}"
+        for m in dropped
+    )
+    if previous:
+        transcript = f"Summary so far: {previous}\n{transcript}"
+    async for _, summary in stream_completion(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": "Summarize this conversation between a user and a coding assistant. Keep file paths, commands and decisions."},
+            {"role": "user", "content": transcript},
+        ],
+    ):
+        pass
+    return summary["content"] or ""
+
+async def _fold(state, cut):
+    # Condense the oldest messages into the summary before evicting them
+    recent = state["messages"]
+    dropped = list(islice(recent, cut))
+    state["summary"] = await _summarize(dropped, state["summary"])
+    for _ in range(cut):
+        recent.popleft()
+
+async def _trim(state, max_turns=MAX_TURNS):
+    # Only trim once the window passes its cap, then cut back to half of it so
+    # the summary call is paid once every several turns rather than every turn
+    recent = state["messages"]
+    starts = [i for i, m in enumerate(recent) if m["role"] == "user"]
+    if len(starts) <= max_turns and len(recent) <= MAX_MESSAGES - TURN_HEADROOM:
+        return state
+
+    # Cut on a user message so tool results are never split from their call
+    keep_turns = max(max_turns // 2, 1)
+    cut = next(
+        (i for i in starts[-keep_turns:] if len(recent) - i <= MAX_MESSAGES // 2),
+        len(recent),
+    )
+    if cut:
+        await _fold(state, cut)
+    # A long turn may have widened the deque; shrink it back to the cap
+    if state["messages"].maxlen != MAX_MESSAGES:
+        state["messages"] = deque(state["messages"], maxlen=MAX_MESSAGES)
+    return state
+
+async def _make_room(state, needed):
+    # Fold earlier turns so needed more messages fit without the deque
+    # silently evicting anything
+    recent = state["messages"]
+    if len(recent) + needed <= recent.maxlen:
+        return recent
+
+    # Never fold the turn in progress
+    starts = [i for i, m in enumerate(recent) if m["role"] == "user"]
+    current = starts[-1] if starts else 0
+    cut = next(
+        (i for i in starts if i <= current and len(recent) - i + needed <= recent.maxlen),
+        current,
+    )
+    if cut:
+        await _fold(state, cut)
+
+    # The turn alone is bigger than the cap; let it through and trim next turn
+    if len(recent) + needed > recent.maxlen:
+        state["messages"] = deque(recent, maxlen=len(recent) + needed)
+    return state["messages"]
+
+async def chat_fn(user_message, history, state, request: gr.Request):
+    session_id = request.session_hash
+
+    await _trim(state)
+    recent = state["messages"]
+    recent.append({"role": "user", "content": user_message})
+
+    # Sandbox calls are blocking, so tools run in worker threads while the
+    # completion keeps streaming
+    scheduler = ToolScheduler(session_id)
+    futures = {}
+    seen = set()
+    pending_writes = []
+
+    def flush_writes():
+        if pending_writes:
+            task = scheduler.submit_writes(list(pending_writes))
+            for tc, _ in pending_writes:
+                futures[tc["id"]] = task
+            pending_writes.clear()
+
+    def submit(tc, final):
+        if tc["id"] in seen:
+            return
+        # Arguments are decoded once here and shared by scheduler and handler
+        try:
+            args, error = decode_tool_args(tc)
+        except msgspec.DecodeError as e:
+            if not final:
+                return  # still streaming
+            args, error = None, f"Error calling {tc['function']['name']}: {e}"
+        seen.add(tc["id"])
+
+        if error is not None:
+            done = asyncio.get_running_loop().create_future()
+            done.set_result(error)
+            futures[tc["id"]] = done
+            return
+
+        # Adjacent write_file calls are held back and sent as one batch
+        if tc["function"]["name"] == "write_file":
+            pending_writes.append((tc, args))
+            return
+        flush_writes()
+        futures[tc["id"]] = scheduler.submit(tc, args)
+
+    async for text, assistant_msg in stream_completion(
+        on_tool_call=submit,
         model=model,
-        messages=messages,
+        messages=_request_messages(state),
         tools=tools,
-    )
+    ):
+        if assistant_msg is None:
+            yield text, state
+    recent.append(assistant_msg)
+    flush_writes()
 
-    assistant_msg = response.choices[0].message
-    messages.append(assistant_msg)
+    tool_calls = assistant_msg.get("tool_calls")
+    if not tool_calls:
+        yield assistant_msg["content"] or "", state
+        return
 
     # DEBUG tool call logging
-    if assistant_msg.tool_calls:
-        print(f"[DEBUG] Assistant requested {len(assistant_msg.tool_calls)} tool call(s).")
-
-        for tc in assistant_msg.tool_calls:
-            print(f"[DEBUG] Tool call detected: {tc.function.name} with args {tc.function.arguments}")
-
-            fn_name = tc.function.name
-            fn_args = json.loads(tc.function.arguments)
-
-            if fn_name == "read_file":
-                result = read_file(**fn_args)
-            elif fn_name == "write_file":
-                result = write_file(**fn_args)
-            elif fn_name == "write_files":
-                result = write_files(**fn_args)
-            elif fn_name == "run_commands":
-                result = run_commands(**fn_args)
-            else:
-                result = f"Unknown tool {fn_name}"
-
-            print(f"[DEBUG] Tool call result: {result}")
-
-            messages.append({
-                "tool_call_id": tc.id,
-                "role": "tool",
-                "content": str(result),
-            })
-
-        followup = client.chat.completions.create(
-            model=model,
-            messages=messages,
-        )
-        final_msg = followup.choices[0].message
-        messages.append(final_msg)
-        return final_msg.content
-
-    return assistant_msg.content
+    log.debug("Assistant requested %d tool call(s).", len(tool_calls))
+
+    # Results go back in the order the model requested them
+    results = await asyncio.gather(*(futures[tc["id"]] for tc in tool_calls))
+    recent = await _make_room(state, len(tool_calls) + 1)
+    for tc, result in zip(tool_calls, results):
+        # Batched writes share one task that holds every call's result
+        if isinstance(result, dict):
+            result = result[tc["id"]]
+        recent.append({
+            "tool_call_id": tc["id"],
+            "role": "tool",
+            "content": result if isinstance(result, str) else str(result),
+        })
+
+    async for text, final_msg in stream_completion(
+        model=model,
+        messages=_request_messages(state),
+    ):
+        if final_msg is None:
+            yield text, state
+    recent.append(final_msg)
+    yield final_msg["content"] or "", state
 
 # -------------------------
 # Command Interface
 # -------------------------
-def execute_command(command):
+def execute_command(command, request: gr.Request):
     if not command.strip():
         return "⚠️ Please enter a command."
-    output = run_commands(command)
+    output = run_in_sandbox(request.session_hash, run_commands, command=command)
     return f"```bash\n{output}\n```"
 
+# -------------------------
+# File Upload
+# -------------------------
+def upload_file(file_path, request: gr.Request):
+    if file_path is None:
+        return "No file uploaded."
+    path = f"{WORKING_DIR}/{os.path.basename(file_path)}"
+    with open(file_path, "rb") as f:
+        data = f.read()
+    msg = run_in_sandbox(request.session_hash, stage_file, path=path, data=data)
+    if msg.startswith("File staged"):
+        return f"📎 Uploaded to `{path}`. Refer to this path in chat."
+    return msg
+
 # -------------------------
 # UI
 # -------------------------
@@ -270,7 +954,12 @@ with gr.Blocks(title="Novita Sandbox App") as demo:
         # Chat
         with gr.Column(scale=2):
             gr.Markdown("### 💬 Chat Interface")
-            gr.ChatInterface(chat_fn)
+            chat_state = gr.State(new_session_state)
+            gr.ChatInterface(
+                chat_fn,
+                additional_inputs=[chat_state],
+                additional_outputs=[chat_state],
+            )
 
         # Controls
         with gr.Column(scale=1):
@@ -280,15 +969,15 @@ with gr.Blocks(title="Novita Sandbox App") as demo:
             sandbox_switch = gr.Checkbox(label="Sandbox On/Off", value=False)
             sandbox_status = gr.Markdown("🔴 Sandbox OFF")
 
-            def toggle_sandbox(is_on):
-                global sandbox_timer
+            def toggle_sandbox(is_on, request: gr.Request):
+                session_id = request.session_hash
                 if is_on:
-                    msg = create_sandbox()
-                    sandbox_timer = threading.Thread(target=sandbox_auto_off, daemon=True)
+                    msg = create_sandbox(session_id)
+                    sandbox_timer = threading.Thread(target=sandbox_auto_off, args=(session_id,), daemon=True)
                     sandbox_timer.start()
                     return "🟢 Sandbox ON"
                 else:
-                    msg = kill_sandbox()
+                    msg = kill_sandbox(session_id)
                     return "🔴 Sandbox OFF"
 
             sandbox_switch.change(toggle_sandbox, inputs=sandbox_switch, outputs=sandbox_status)
@@ -314,8 +1003,13 @@ with gr.Blocks(title="Novita Sandbox App") as demo:
             command_output = gr.Markdown("Command output here...")
             run_btn.click(execute_command, inputs=command_input, outputs=command_output)
 
+            # File Upload
+            upload_input = gr.File(label="Upload to sandbox", type="filepath")
+            upload_status = gr.Markdown("")
+            upload_input.upload(upload_file, inputs=upload_input, outputs=upload_status)
+
 # Cleanup
-atexit.register(lambda: (kill_sandbox(), print("[DEBUG] Sandbox terminated.")))
+atexit.register(lambda: (pool.kill_all(), log.info("Sandbox terminated.")))
 
 if __name__ == "__main__":
     demo.launch()